@@ -4,13 +4,29 @@ import re
 from collections import Counter, defaultdict
 import argparse
 import os
+import functools
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
+# --- NEW: The model ships in the image; never let transformers reach for the Hub.
+# These must be set before sentence_transformers / transformers are imported.
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+
 # --- NEW: Import new libraries for hybrid ranking and sub-section analysis ---
+import torch
 from sentence_transformers import SentenceTransformer, util
 from rank_bm25 import BM25Okapi
 import nltk
 
+# --- NEW: ONNX Runtime runs an int8-quantized MiniLM when one has been exported; optional.
+try:
+    import onnxruntime as ort
+    from transformers import AutoTokenizer
+except ImportError:
+    ort = None
+
 # --- NEW: Pre-download NLTK data. This should be run once.
 # In your Dockerfile, you should add these lines to ensure offline access:
 # RUN python -c "import nltk; nltk.download('punkt'); nltk.download('stopwords')"
@@ -26,6 +42,71 @@ except nltk.downloader.DownloadError:
 from nltk.corpus import stopwords
 stop_words = set(stopwords.words('english'))
 
+# --- NEW: Regexes used in per-block / per-section loops, compiled once at import time ---
+_WIN_DRIVE_RE = re.compile(r'^[a-zA-Z]:\\')
+_ALPHA_RE = re.compile(r'[a-zA-Z]')
+_DOTS_RE = re.compile(r'\.{4,}')
+_BULLET_RE = re.compile(r'^\s*([•*-]|[a-zA-Z\d]+\))\s+')
+_NUMBERED_RE = re.compile(r'^\s*(\d+(\.\d+)*)\s+')
+_FILE_EXT_RE = re.compile(r'\.(pdf|docx?|pptx?|xlsx?|cdr)$', re.I)
+_HYPHEN_BREAK_RE = re.compile(r'(\w)-\n(\w)')
+_NEWLINE_RE = re.compile(r'\s*\n\s*')
+_WORD_RE = re.compile(r'\b\w+\b')
+_WS_RE = re.compile(r'\s+')
+
+_BOLD_TOKENS = ('bold', 'black', 'heavy', 'condb', 'cbi')
+
+# --- NEW: Split the cores between the encoder's intra-op threads and the PDF worker pool,
+# which run at the same time, so together they never oversubscribe the CPU ---
+ENCODER_THREADS = max(1, (os.cpu_count() or 1) // 2)
+PDF_WORKERS = max(1, (os.cpu_count() or 1) - ENCODER_THREADS)
+
+
+class PageTextCache:
+    """
+    Lazily caches each page's `get_text("dict")` output, plus the MuPDF TextPage
+    of pages that are also searched, so every text query on a page shares a
+    single layout pass.
+    """
+    # Both consumers skip image blocks, so don't have MuPDF decode and embed image bytes
+    TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+    def __init__(self, doc):
+        self.doc = doc
+        # A TextPage only weakly references its Page and can only be used with that same Page
+        # object, so both are cached together; `doc[n]` would return a fresh Page each time.
+        self._pages = [None] * doc.page_count
+        self._textpages = [None] * doc.page_count
+        self._page_dicts = [None] * doc.page_count
+
+    def get_page(self, page_num: int):
+        if self._pages[page_num] is None:
+            self._pages[page_num] = self.doc[page_num]
+        return self._pages[page_num]
+
+    def get_textpage(self, page_num: int):
+        if self._textpages[page_num] is None:
+            self._textpages[page_num] = self.get_page(page_num).get_textpage(flags=self.TEXT_FLAGS)
+        return self._textpages[page_num]
+
+    def get_page_dict(self, page_num: int) -> dict:
+        if self._page_dicts[page_num] is None:
+            # Reuse a TextPage already built for search_for; otherwise build one only for this
+            # call and let it go right away, since the cached dict is all later passes need
+            textpage = self._textpages[page_num] or self.get_page(page_num).get_textpage(flags=self.TEXT_FLAGS)
+            self._page_dicts[page_num] = self.get_page(page_num).get_text("dict", textpage=textpage)
+            del textpage
+        return self._page_dicts[page_num]
+
+    def release_textpages(self):
+        """Frees the MuPDF TextPages and their Pages; the extracted dicts stay cached."""
+        self._textpages = [None] * len(self._textpages)
+        self._pages = [None] * len(self._pages)
+
+    @property
+    def page_dicts(self) -> list:
+        return [self.get_page_dict(page_num) for page_num in range(self.doc.page_count)]
+
 
 # =====================================================================================
 # COMPONENT 1: PDF Outline Extractor (No changes needed, it's a solid base)
@@ -35,57 +116,80 @@ class PDFOutlineExtractor:
     Extracts a hierarchical outline using an advanced, multi-pass structural
     analysis pipeline for high-precision heading detection.
     """
-    def __init__(self, pdf_path: str):
+    def __init__(self, doc_or_path, text_cache: PageTextCache = None):
+        # An already-opened document is borrowed as-is; only a path is opened (and owned) here.
+        if isinstance(doc_or_path, fitz.Document):
+            self.doc = doc_or_path
+            self._owns_doc = False
+            self.text_cache = text_cache or PageTextCache(self.doc)
+            return
+        pdf_path = doc_or_path
         try:
-            if len(pdf_path) > 260 and re.match(r'^[a-zA-Z]:\\', pdf_path):
+            if len(pdf_path) > 260 and _WIN_DRIVE_RE.match(pdf_path):
                  pdf_path = "\\\\?\\" + pdf_path
             self.doc = fitz.open(pdf_path)
+            self._owns_doc = True
         except Exception as e:
             raise FileNotFoundError(f"Error opening or reading PDF file: {e}")
+        self.text_cache = PageTextCache(self.doc)
 
-    def _is_bold_by_name(self, font_name: str) -> bool:
-        return any(x in font_name.lower() for x in ['bold', 'black', 'heavy', 'condb', 'cbi'])
+    def close(self):
+        self.text_cache.release_textpages()
+        if self._owns_doc:
+            self.doc.close()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _is_bold_by_name(font_name: str) -> bool:
+        # Called once per span, but a PDF only uses a handful of distinct font names
+        font_name = font_name.lower()
+        return any(token in font_name for token in _BOLD_TOKENS)
 
     def _get_text_blocks(self):
         """Pass 1: Reconstruct the document into logical text blocks."""
         blocks = []
-        for page in self.doc:
-            for block in page.get_text("dict")["blocks"]:
+        for page_num, page_dict in enumerate(self.text_cache.page_dicts):
+            for block in page_dict["blocks"]:
                 if block['type'] == 0: # Text block
-                    block_text = ""
-                    span_styles = []
+                    text_parts = []
+                    style_counts = {}
                     for line in block["lines"]:
                         for span in line["spans"]:
-                            block_text += span["text"] + " "
-                            span_styles.append((round(span['size']), self._is_bold_by_name(span['font'])))
+                            text_parts.append(span["text"])
+                            style = (round(span['size']), self._is_bold_by_name(span['font']))
+                            style_counts[style] = style_counts.get(style, 0) + 1
                     
-                    if not block_text.strip() or not re.search('[a-zA-Z]', block_text): continue
-                    if not span_styles: continue
-                    dominant_style = Counter(span_styles).most_common(1)[0][0]
+                    # Normalize whitespace once here so later passes can use the text as-is
+                    block_text = _WS_RE.sub(' ', " ".join(text_parts)).strip()
+                    if not block_text or not _ALPHA_RE.search(block_text): continue
+                    if not style_counts: continue
+                    # max() keeps the first-seen style on ties, matching Counter.most_common(1)
+                    dominant_style = max(style_counts, key=style_counts.get)
                     
                     blocks.append({
-                        'text': block_text.strip(),
+                        'text': block_text,
                         'style': dominant_style,
                         'bbox': block['bbox'],
-                        'page_num': page.number + 1,
+                        'page_num': page_num + 1,
                         'num_lines': len(block['lines']),
-                        'num_words': len(block_text.split())
+                        'num_words': block_text.count(' ') + 1
                     })
         return blocks
 
     def _find_body_style(self, blocks):
         """Pass 2: Identify the primary body text style based on total word count."""
-        style_word_counts = defaultdict(int)
-        for block in blocks:
-            if block['num_lines'] > 2 or block['num_words'] > 20:
-                style_word_counts[block['style']] += block['num_words']
+        # Encode each (size, bold) style as size*2+bold so word totals reduce to one bincount
+        body_blocks = [b for b in blocks if b['num_lines'] > 2 or b['num_words'] > 20]
         
-        if not style_word_counts:
+        if not body_blocks:
             style_freq = Counter(b['style'] for b in blocks)
             if not style_freq: return None
             return style_freq.most_common(1)[0][0]
 
-        return max(style_word_counts, key=style_word_counts.get)
+        codes = np.fromiter(((b['style'][0] << 1) | b['style'][1] for b in body_blocks), dtype=np.int64, count=len(body_blocks))
+        word_counts = np.fromiter((b['num_words'] for b in body_blocks), dtype=np.int64, count=len(body_blocks))
+        code = int(np.bincount(codes, weights=word_counts).argmax())
+        return (code >> 1, bool(code & 1))
 
     def get_outline(self) -> dict:
         """Orchestrates the multi-pass pipeline to extract the outline."""
@@ -94,8 +198,11 @@ class PDFOutlineExtractor:
         toc = self.doc.get_toc()
         if toc:
             outline = [{"level": f"H{level}", "text": text.strip(), "page_num": page, "bbox": None} for level, text, page in toc if 1 <= level <= 4]
-            outline = [h for h in outline if re.search('[a-zA-Z]', h['text'])]
+            outline = [h for h in outline if _ALPHA_RE.search(h['text'])]
             if outline:
+                for heading in outline:
+                    heading['bbox'] = self._locate_toc_heading(heading['text'], heading['page_num'])
+                self.text_cache.release_textpages()
                 return {"title": title, "outline": outline}
 
         all_blocks = self._get_text_blocks()
@@ -106,20 +213,20 @@ class PDFOutlineExtractor:
         if not body_style:
             return {"title": title, "outline": []}
 
-        heading_blocks = []
-        for block in all_blocks:
-            if block['num_words'] > 30 or block['num_lines'] > 3:
-                continue
-            
-            is_candidate = block['style'][0] > body_style[0] or \
-                           (block['style'][0] == body_style[0] and block['style'][1] and not body_style[1])
-            if not is_candidate:
-                continue
+        # Numeric filters run as boolean masks; only the surviving blocks reach the regex checks
+        block_meta = np.fromiter(((b['style'][0], b['style'][1], b['num_words'], b['num_lines']) for b in all_blocks),
+                                 dtype=[('size', 'i4'), ('bold', '?'), ('nw', 'i4'), ('nl', 'i4')], count=len(all_blocks))
+        body_size, body_bold = body_style
+        is_candidate = (block_meta['nw'] <= 30) & (block_meta['nl'] <= 3) & \
+                       ((block_meta['size'] > body_size) | ((block_meta['size'] == body_size) & block_meta['bold'] & (not body_bold)))
 
-            text = block['text'].strip()
-            if re.search(r'\.{4,}', text) or text.endswith(('.', ',', ';', ':')):
+        heading_blocks = []
+        for idx in np.flatnonzero(is_candidate):
+            block = all_blocks[idx]
+            text = block['text']
+            if _DOTS_RE.search(text) or text.endswith(('.', ',', ';', ':')):
                 continue
-            if re.match(r'^\s*([•*-]|[a-zA-Z\d]+\))\s+', text):
+            if _BULLET_RE.match(text):
                 continue
 
             heading_blocks.append(block)
@@ -147,13 +254,12 @@ class PDFOutlineExtractor:
                  style_to_level[style] = level
 
         final_outline = []
-        list_item_pattern = re.compile(r'^\s*(\d+(\.\d+)*)\s+')
         for block in heading_blocks:
             if block['style'] in style_to_level:
                 level = style_to_level[block['style']]
-                text = ' '.join(block['text'].split())
+                text = block['text']
                 
-                match = list_item_pattern.match(text)
+                match = _NUMBERED_RE.match(text)
                 if match:
                     dot_count = match.group(1).count('.')
                     level = f"H{dot_count + 1}"
@@ -165,22 +271,31 @@ class PDFOutlineExtractor:
         
         return {"title": title, "outline": sorted(final_outline, key=lambda x: (x['page_num'], x['bbox'][1] if x['bbox'] else 0))}
 
+    def _locate_toc_heading(self, text: str, page_num: int):
+        """Resolves a TOC entry to its on-page bbox so the sectionizer can split on it."""
+        if not 1 <= page_num <= self.doc.page_count:
+            return None
+        page = self.text_cache.get_page(page_num - 1)
+        rects = page.search_for(text, quads=False, textpage=self.text_cache.get_textpage(page_num - 1))
+        return tuple(rects[0]) if rects else None
+
     def _extract_title(self) -> str:
         if self.doc.metadata and (title := self.doc.metadata.get("title", "").strip()):
-            if len(title) > 4 and not re.search(r'\.(pdf|docx?|pptx?|xlsx?|cdr)$', title, re.I) and "Microsoft Word" not in title:
+            if len(title) > 4 and not _FILE_EXT_RE.search(title) and "Microsoft Word" not in title:
                 return title
         if not self.doc or self.doc.page_count == 0: return ""
-        first_page = self.doc[0]
-        top_rect = fitz.Rect(0, 0, first_page.rect.width, first_page.rect.height * 0.4)
-        blocks = first_page.get_text("dict", clip=top_rect).get('blocks', [])
+        # Reuse the cached page-0 dict instead of a clipped re-extraction of the top 40%
+        top_y = self.text_cache.get_page(0).rect.height * 0.4
+        blocks = self.text_cache.get_page_dict(0).get('blocks', [])
         font_sizes = defaultdict(list)
         for block in blocks:
-            if block['type'] == 0:
+            if block['type'] == 0 and block['bbox'][1] < top_y:
                 for line in block['lines']:
-                    line_text = " ".join(s['text'].strip() for s in line['spans'] if s['text'].strip()).strip()
-                    if line_text and re.search('[a-zA-Z]', line_text) and len(line_text.split()) < 20:
-                        if line['spans']:
-                            avg_size = round(sum(s['size'] for s in line['spans']) / len(line['spans']))
+                    spans = [s for s in line['spans'] if s['bbox'][3] <= top_y]
+                    line_text = " ".join(s['text'].strip() for s in spans if s['text'].strip()).strip()
+                    if line_text and _ALPHA_RE.search(line_text) and len(line_text.split()) < 20:
+                        if spans:
+                            avg_size = round(sum(s['size'] for s in spans) / len(spans))
                             font_sizes[avg_size].append(line_text)
         if font_sizes:
             max_size = max(font_sizes.keys())
@@ -193,10 +308,45 @@ class PDFOutlineExtractor:
 class DocumentSectionizer:
     def __init__(self, pdf_path: str):
         self.doc = fitz.open(pdf_path)
-        # Use a more robust way to handle potential empty outlines
-        outline_data = PDFOutlineExtractor(pdf_path).get_outline()
+        self.text_cache = PageTextCache(self.doc)
+        self._span_index = [None] * self.doc.page_count
+        # Share the opened document with the extractor so the PDF is parsed only once
+        outline_data = PDFOutlineExtractor(self.doc, self.text_cache).get_outline()
         self.outline = outline_data.get('outline', [])
 
+    def close(self):
+        self.text_cache.release_textpages()
+        self.doc.close()
+
+    def _get_span_index(self, page_num: int) -> tuple:
+        """Builds (once per page) the page's spans sorted by vertical midpoint, plus the sort keys."""
+        if self._span_index[page_num] is None:
+            spans = []  # (y_mid, reading_order, line_no, text)
+            line_no = 0
+            for block in self.text_cache.get_page_dict(page_num)["blocks"]:
+                if block['type'] != 0: continue
+                for line in block["lines"]:
+                    for span in line["spans"]:
+                        spans.append(((span["bbox"][1] + span["bbox"][3]) / 2, len(spans), line_no, span["text"]))
+                    line_no += 1
+            spans.sort()
+            self._span_index[page_num] = ([span[0] for span in spans], spans)
+        return self._span_index[page_num]
+
+    def _get_text_in_range(self, page_num: int, y_start: float, y_end: float) -> str:
+        """Rebuilds the plain text of lines whose spans fall vertically within [y_start, y_end]."""
+        keys, spans = self._get_span_index(page_num)
+        selected = sorted(spans[bisect_left(keys, y_start):bisect_right(keys, y_end)], key=lambda span: span[1])
+        lines = []
+        line_parts, current_line = [], None
+        for _, _, line_no, span_text in selected + [(None, None, None, "")]:
+            if line_no != current_line:
+                if line_text := "".join(line_parts):
+                    lines.append(line_text + "\n")
+                line_parts, current_line = [], line_no
+            line_parts.append(span_text)
+        return "".join(lines)
+
     def get_sections(self) -> list:
         sections = []
         for i, heading in enumerate(self.outline):
@@ -216,19 +366,18 @@ class DocumentSectionizer:
                 end_y = next_heading['bbox'][1]
             else:
                 end_page = len(self.doc) - 1
-                end_y = self.doc[end_page].rect.height
+                end_y = self.text_cache.get_page(end_page).rect.height
             
-            content = ""
+            content_parts = []
             for page_num in range(start_page, end_page + 1):
-                page = self.doc[page_num]
+                page = self.text_cache.get_page(page_num)
                 clip_y_start = start_y if page_num == start_page else 0
                 clip_y_end = end_y if page_num == end_page else page.rect.height
                 if clip_y_start < clip_y_end:
-                    clip_rect = fitz.Rect(0, clip_y_start, page.rect.width, clip_y_end)
-                    content += page.get_text(clip=clip_rect)
+                    content_parts.append(self._get_text_in_range(page_num, clip_y_start, clip_y_end))
             
-            cleaned_content = re.sub(r'(\w)-\n(\w)', r'\1\2', content)
-            cleaned_content = re.sub(r'\s*\n\s*', ' ', cleaned_content)
+            cleaned_content = _HYPHEN_BREAK_RE.sub(r'\1\2', "".join(content_parts))
+            cleaned_content = _NEWLINE_RE.sub(' ', cleaned_content)
             cleaned_content = ' '.join(cleaned_content.split())
 
             sections.append({
@@ -242,15 +391,74 @@ class DocumentSectionizer:
 class QueryProcessor:
     def get_keywords(self, text: str, max_keywords=10) -> list:
         """Extracts keywords by removing stop words and taking most frequent terms."""
-        words = re.findall(r'\b\w+\b', text.lower())
+        words = _WORD_RE.findall(text.lower())
         filtered_words = [word for word in words if word not in stop_words and len(word) > 2]
         return [word for word, freq in Counter(filtered_words).most_common(max_keywords)]
 
+# --- NEW: int8 ONNX encoder, a drop-in for the subset of SentenceTransformer.encode used here ---
+class OnnxSentenceEncoder:
+    """
+    Runs a dynamically int8-quantized MiniLM export with ONNX Runtime on CPU.
+    Reproduces the model's Transformer -> mean Pooling -> Normalize pipeline.
+    """
+    ONNX_FILENAME = os.path.join('onnx', 'model_quantized.onnx')
+
+    def __init__(self, model_path: str, max_seq_length: int = 256, num_threads: int = ENCODER_THREADS):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(os.path.join(model_path, self.ONNX_FILENAME),
+                                            sess_options=session_options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.max_seq_length = max_seq_length
+
+    @classmethod
+    def is_available(cls, model_path: str) -> bool:
+        return ort is not None and os.path.exists(os.path.join(model_path, cls.ONNX_FILENAME))
+
+    def _encode_batch(self, sentences: list) -> np.ndarray:
+        features = self.tokenizer(sentences, padding=True, truncation=True,
+                                  max_length=self.max_seq_length, return_tensors='np')
+        inputs = {name: features[name].astype(np.int64) for name in features if name in self.input_names}
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = features['attention_mask'][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True,
+               convert_to_tensor=False, normalize_embeddings=False):
+        single = isinstance(sentences, str)
+        if single: sentences = [sentences]
+        # Sort by length like SentenceTransformer's smart batching to minimize padding
+        order = np.argsort([-len(s) for s in sentences], kind='stable')
+        batches = [self._encode_batch([sentences[i] for i in order[start:start + batch_size]])
+                   for start in range(0, len(sentences), batch_size)]
+        sorted_embeddings = np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        if single: embeddings = embeddings[0]
+        if convert_to_tensor:
+            return torch.from_numpy(embeddings)
+        return embeddings
+
 # --- NEW: COMPONENT 4: Hybrid Ranker (Replaces SemanticRanker) ---
 class HybridRanker:
+    STREAM_BATCH_SIZE = 64
+
     def __init__(self, model_path='all-MiniLM-L6-v2-local', alpha=0.7):
+        # Stay within the encoder's share of the cores and avoid nested inter-op threads
+        torch.set_num_threads(ENCODER_THREADS)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass # Already fixed once any inter-op parallel work has run
         try:
-            self.model = SentenceTransformer(model_path)
+            # Prefer the int8 ONNX export (see Dockerfile); fall back to the FP32 PyTorch model
+            if OnnxSentenceEncoder.is_available(model_path):
+                self.model = OnnxSentenceEncoder(model_path)
+            else:
+                self.model = SentenceTransformer(model_path, device='cpu')
             self.alpha = alpha # Weight for semantic score
         except Exception as e:
             raise IOError(f"Failed to load model from {model_path}. Error: {e}")
@@ -262,15 +470,44 @@ class HybridRanker:
             return [0.5] * len(scores) # Avoid division by zero
         return [(s - min_score) / (max_score - min_score) for s in scores]
 
-    def rank_sections(self, query: str, query_keywords: list, all_sections: list) -> list:
+    @staticmethod
+    def _similarity(section_embeddings: np.ndarray, query_embedding: np.ndarray) -> np.ndarray:
+        """Sections @ query. FP16 section matrices (from encode_sections) are used as stored, without upcasting."""
+        if section_embeddings.dtype == np.float16:
+            try:
+                query = torch.from_numpy(query_embedding.astype(np.float16))
+                return torch.matmul(torch.from_numpy(section_embeddings), query).float().numpy()
+            except RuntimeError:
+                # Older CPU builds of torch have no FP16 matmul kernel
+                section_embeddings = section_embeddings.astype(np.float32)
+        return section_embeddings @ query_embedding
+
+    def encode_sections(self, section_contents: list) -> np.ndarray:
+        """Encodes a chunk of section texts to L2-normalized embeddings, for incremental use."""
+        embeddings = self.model.encode(section_contents, batch_size=self.STREAM_BATCH_SIZE, show_progress_bar=False,
+                                       convert_to_numpy=True, normalize_embeddings=True)
+        # Stored as FP16 once, here, so the accumulated matrix and its GEMV read half the bytes
+        return embeddings.astype(np.float16)
+
+    def rank_sections(self, query: str, query_keywords: list, all_sections: list, section_embeddings=None,
+                      top_k: int = 10) -> list:
         if not all_sections: return [], None
         
         section_contents = [sec['content'] for sec in all_sections]
         
         # 1. Semantic Scoring
-        query_embedding = self.model.encode(query, convert_to_tensor=True)
-        section_embeddings = self.model.encode(section_contents, convert_to_tensor=True)
-        semantic_scores = util.cos_sim(query_embedding, section_embeddings).tolist()[0]
+        if section_embeddings is None:
+            # One encode call for query + sections lets smart batching sort by length,
+            # and normalized outputs reduce cosine similarity to a plain dot product.
+            embeddings = self.model.encode([query] + section_contents, batch_size=32, show_progress_bar=False,
+                                           convert_to_numpy=True, normalize_embeddings=True)
+            query_embedding = embeddings[:1]
+            section_embeddings = embeddings[1:]
+        else:
+            query_embedding = self.model.encode([query], show_progress_bar=False,
+                                                convert_to_numpy=True, normalize_embeddings=True)
+        # Both sides are already unit-length, so cosine similarity is a single GEMV
+        semantic_scores = self._similarity(section_embeddings, query_embedding[0]).tolist()
         
         # 2. Lexical Scoring (BM25)
         tokenized_corpus = [doc.lower().split() for doc in section_contents]
@@ -281,11 +518,22 @@ class HybridRanker:
         norm_semantic = self._normalize_scores(semantic_scores)
         norm_lexical = self._normalize_scores(lexical_scores)
         
-        for i, section in enumerate(all_sections):
-            hybrid_score = (self.alpha * norm_semantic[i]) + ((1 - self.alpha) * norm_lexical[i])
+        hybrid_scores = self.alpha * np.asarray(norm_semantic) + (1 - self.alpha) * np.asarray(norm_lexical)
+        for section, hybrid_score in zip(all_sections, hybrid_scores.tolist()):
             section['relevance_score'] = hybrid_score
-            
-        return sorted(all_sections, key=lambda x: x['relevance_score'], reverse=True), query_embedding
+
+        # Callers only consume the head of the ranking, so select the top_k in O(N) and sort just those
+        if len(all_sections) > top_k:
+            kth_score = -np.partition(-hybrid_scores, top_k - 1)[top_k - 1]
+            above = np.flatnonzero(hybrid_scores > kth_score)
+            # Sections tied at the k-th score are taken in document order, as a stable sort would
+            at_kth = np.flatnonzero(hybrid_scores == kth_score)[:top_k - len(above)]
+            top_indices = np.concatenate((above, at_kth))
+        else:
+            top_indices = np.arange(len(all_sections))
+        # Ties keep document order, as the previous stable sort did
+        top_indices = top_indices[np.lexsort((top_indices, -hybrid_scores[top_indices]))]
+        return [all_sections[i] for i in top_indices], query_embedding
 
 # --- NEW: COMPONENT 5: Sub-Section Analyzer ---
 class SubSectionAnalyzer:
@@ -319,6 +567,23 @@ class SubSectionAnalyzer:
 # =====================================================================================
 # MAIN EXECUTION BLOCK (MODIFIED)
 # =====================================================================================
+def _process_pdf(pdf_path: str, doc_name: str) -> list:
+    """Sectionizes a single PDF. Runs in a worker process, so it must stay picklable."""
+    print(f"  - Sectionizing: {doc_name}")
+    if not os.path.exists(pdf_path):
+        print(f"    - Warning: File not found, skipping: {pdf_path}")
+        return []
+    try:
+        sectionizer = DocumentSectionizer(pdf_path)
+        sections = sectionizer.get_sections()
+        sectionizer.close()
+    except Exception as e:
+        print(f"    - Could not process {doc_name}. Error: {e}")
+        return []
+    for section in sections:
+        section['document'] = doc_name
+    return sections
+
 def main():
     parser = argparse.ArgumentParser(description="Persona-Driven Document Intelligence System.")
     # --- MODIFIED: The script now processes all subdirectories in the input folder ---
@@ -326,95 +591,104 @@ def main():
     parser.add_argument("output_dir", type=str, help="Path to the main output directory.")
     args = parser.parse_args()
 
-    # --- MODIFIED: Load models and analyzers once ---
+    # --- MODIFIED: Load models and analyzers once (the ranker lazily, once the workers exist) ---
     model_path = os.environ.get("MODEL_PATH", "all-MiniLM-L6-v2-local")
-    ranker = HybridRanker(model_path=model_path, alpha=0.7)
-    sub_section_analyzer = SubSectionAnalyzer(model=ranker.model)
+    ranker = None
+    sub_section_analyzer = None
     query_processor = QueryProcessor()
     
-    # --- MODIFIED: Loop through each test case directory in the input folder ---
-    for collection_name in os.listdir(args.input_dir):
-        collection_dir = os.path.join(args.input_dir, collection_name)
-        if not os.path.isdir(collection_dir):
-            continue
-
-        print(f"--- Processing Collection: {collection_name} ---")
-        input_json_path = os.path.join(collection_dir, 'challenge1b_input.json')
+    # --- NEW: One worker pool for the whole run, created before the model is loaded ---
+    with ProcessPoolExecutor(max_workers=PDF_WORKERS) as executor:
+        # --- MODIFIED: Loop through each test case directory in the input folder ---
+        for collection_name in os.listdir(args.input_dir):
+            collection_dir = os.path.join(args.input_dir, collection_name)
+            if not os.path.isdir(collection_dir):
+                continue
+
+            print(f"--- Processing Collection: {collection_name} ---")
+            input_json_path = os.path.join(collection_dir, 'challenge1b_input.json')
         
-        try:
-            with open(input_json_path, 'r', encoding='utf-8') as f: config = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Error reading or parsing {input_json_path}: {e}")
-            continue
+            try:
+                with open(input_json_path, 'r', encoding='utf-8') as f: config = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                print(f"Error reading or parsing {input_json_path}: {e}")
+                continue
         
-        persona = config.get('persona', {}).get('role', '')
-        job_to_be_done = config.get('job_to_be_done', {}).get('task', '')
-        query_text = f"User Persona: {persona}. Task: {job_to_be_done}"
-        query_keywords = query_processor.get_keywords(query_text)
+            persona = config.get('persona', {}).get('role', '')
+            job_to_be_done = config.get('job_to_be_done', {}).get('task', '')
+            query_text = f"User Persona: {persona}. Task: {job_to_be_done}"
+            query_keywords = query_processor.get_keywords(query_text)
 
-        documents = config.get('documents', [])
-        pdf_dir = os.path.join(collection_dir, 'PDFs')
+            documents = config.get('documents', [])
+            pdf_dir = os.path.join(collection_dir, 'PDFs')
         
-        all_sections = []
-        for doc in documents:
-            pdf_path = os.path.join(pdf_dir, doc['filename'])
-            doc_name = doc['filename']
-            print(f"  - Sectionizing: {doc_name}")
-            if not os.path.exists(pdf_path):
-                print(f"    - Warning: File not found, skipping: {pdf_path}")
-                continue
-            try:
-                sectionizer = DocumentSectionizer(pdf_path)
-                sections = sectionizer.get_sections()
-                for section in sections:
-                    section['document'] = doc_name
-                all_sections.extend(sections)
-            except Exception as e:
-                print(f"    - Could not process {doc_name}. Error: {e}")
+            pdf_paths = [os.path.join(pdf_dir, doc['filename']) for doc in documents]
+            doc_names = [doc['filename'] for doc in documents]
+
+            # --- NEW: Sectionize PDFs in parallel and embed their sections as they arrive, so
+            # encoding overlaps with the parsing still running in the worker processes ---
+            results = executor.map(_process_pdf, pdf_paths, doc_names)
 
-        if not all_sections:
-            print("  - No sections extracted. Skipping ranking.")
-            continue
+            # map() has already submitted every PDF, so the workers exist before the model loads
+            # and never inherit its weights
+            if ranker is None:
+                ranker = HybridRanker(model_path=model_path, alpha=0.7)
+                sub_section_analyzer = SubSectionAnalyzer(model=ranker.model)
 
-        print(f"  - Ranking {len(all_sections)} sections...")
-        ranked_sections, query_embedding = ranker.rank_sections(query_text, query_keywords, all_sections)
+            all_sections, embedding_chunks, pending = [], [], []
+            for sections in results:
+                all_sections.extend(sections)
+                pending.extend(section['content'] for section in sections)
+                while len(pending) >= HybridRanker.STREAM_BATCH_SIZE:
+                    embedding_chunks.append(ranker.encode_sections(pending[:HybridRanker.STREAM_BATCH_SIZE]))
+                    del pending[:HybridRanker.STREAM_BATCH_SIZE]
+            if pending:
+                embedding_chunks.append(ranker.encode_sections(pending))
+
+            if not all_sections:
+                print("  - No sections extracted. Skipping ranking.")
+                continue
+
+            print(f"  - Ranking {len(all_sections)} sections...")
+            ranked_sections, query_embedding = ranker.rank_sections(query_text, query_keywords, all_sections,
+                                                                    section_embeddings=np.concatenate(embedding_chunks))
         
-        output_data = {
-            "metadata": {
-                "input_documents": [doc['filename'] for doc in documents],
-                "persona": persona,
-                "job_to_be_done": job_to_be_done
-            },
-            "extracted_sections": [],
-            "subsection_analysis": []
-        }
+            output_data = {
+                "metadata": {
+                    "input_documents": [doc['filename'] for doc in documents],
+                    "persona": persona,
+                    "job_to_be_done": job_to_be_done
+                },
+                "extracted_sections": [],
+                "subsection_analysis": []
+            }
         
-        for i, section in enumerate(ranked_sections[:10]):
-            output_data["extracted_sections"].append({
-                "document": section['document'],
-                "section_title": section['section_title'],
-                "importance_rank": i + 1,
-                "page_number": section['page_number']
-            })
+            for i, section in enumerate(ranked_sections[:10]):
+                output_data["extracted_sections"].append({
+                    "document": section['document'],
+                    "section_title": section['section_title'],
+                    "importance_rank": i + 1,
+                    "page_number": section['page_number']
+                })
             
-        print("  - Generating refined text for top sections...")
-        for section in ranked_sections[:5]:
-            refined_text = sub_section_analyzer.get_refined_text(section['content'], query_embedding)
-            output_data["subsection_analysis"].append({
-                "document": section['document'],
-                "refined_text": refined_text,
-                "page_number": section['page_number']
-            })
+            print("  - Generating refined text for top sections...")
+            for section in ranked_sections[:5]:
+                refined_text = sub_section_analyzer.get_refined_text(section['content'], query_embedding)
+                output_data["subsection_analysis"].append({
+                    "document": section['document'],
+                    "refined_text": refined_text,
+                    "page_number": section['page_number']
+                })
         
-        # --- MODIFIED: Create a subdirectory in the output for each collection ---
-        collection_output_dir = os.path.join(args.output_dir, collection_name)
-        os.makedirs(collection_output_dir, exist_ok=True)
-        output_json_path = os.path.join(collection_output_dir, 'challenge1b_output.json')
+            # --- MODIFIED: Create a subdirectory in the output for each collection ---
+            collection_output_dir = os.path.join(args.output_dir, collection_name)
+            os.makedirs(collection_output_dir, exist_ok=True)
+            output_json_path = os.path.join(collection_output_dir, 'challenge1b_output.json')
 
-        with open(output_json_path, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=4, ensure_ascii=False)
+            with open(output_json_path, 'w', encoding='utf-8') as f:
+                json.dump(output_data, f, indent=4, ensure_ascii=False)
         
-        print(f"--- Analysis for {collection_name} complete. Output saved to {output_json_path} ---\n")
+            print(f"--- Analysis for {collection_name} complete. Output saved to {output_json_path} ---\n")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file